@@ -4,13 +4,16 @@ A conversational chatbot implemented using LangGraph and LangChain.
 This chatbot maintains a conversation until the user types 'quit'.
 """
 
-from typing import Annotated, List
+from typing import Annotated, List, Optional
 from typing_extensions import TypedDict
 from rich import print as rprint
 from dotenv import load_dotenv
+import asyncio
 import os
+import re
+import threading
 
-from langchain_openai import ChatOpenAI
+from upstream_pool import UpstreamPool
 from langchain.schema import HumanMessage, AIMessage, SystemMessage
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
@@ -19,37 +22,123 @@ from langgraph.graph.message import add_messages
 load_dotenv()
 
 # Check if API key is available
-if not os.getenv("OPENAI_API_KEY"):
+if not os.getenv("OPENAI_API_KEY") and not os.getenv("OPENAI_UPSTREAMS"):
     raise ValueError("OPENAI_API_KEY not found in environment variables. Please check your .env file.")
 
 class State(TypedDict):
-    """State schema for the conversation graph."""
+    """State schema for the conversation graph.
+
+    ``history`` holds the earlier turns and is read as-is, without a reducer,
+    so its size does not affect per-turn graph overhead. ``messages`` only
+    carries the messages of the current turn.
+    """
+    history: List[HumanMessage | AIMessage | SystemMessage]
     messages: Annotated[List[HumanMessage | AIMessage | SystemMessage], add_messages]
     should_continue: bool
 
 
+class InputRejected(Exception):
+    """Raised by the pre-check node when a user message should not reach the LLM."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+# Reply added to the conversation when the LLM call fails
+ERROR_REPLY = "I apologize, I encountered an error. Please try again."
+
+# Cheap local spam/junk heuristics used by the pre-check node
+URL_PATTERN = re.compile(r"https?://|www\.", re.IGNORECASE)
+REPEATED_CHAR_PATTERN = re.compile(r"(.)\1{19,}", re.DOTALL)
+MAX_LINKS = 2
+MIN_DISTINCT_CHARS = 4
+MIN_CHECK_LENGTH = 20  # Shorter messages ("yes", "?", "👍") skip the length-based rules
+
+
+def _normalize(text: str) -> str:
+    """Lower-case and collapse whitespace so near-identical messages compare equal."""
+    return " ".join(text.lower().split())
+
+
+def check_message(text: str, previous: Optional[str] = None, previous_failed: bool = False) -> Optional[str]:
+    """Return a rejection reason for a user message, or None if it looks fine.
+    
+    Args:
+        text: The message the user just sent.
+        previous: The user's previous message in this conversation, if any.
+        previous_failed: Whether the previous turn ended without a real answer,
+            in which case resending the same message is a legitimate retry.
+    """
+    normalized = _normalize(text)
+    long_enough = len(normalized) >= MIN_CHECK_LENGTH
+    if (long_enough and not previous_failed and previous is not None
+            and normalized == _normalize(previous)):
+        return "repeated message"
+    if len(URL_PATTERN.findall(text)) > MAX_LINKS:
+        return "too many links"
+    if REPEATED_CHAR_PATTERN.search(text):
+        return "repeated characters"
+    if long_enough and len(set(normalized)) < MIN_DISTINCT_CHARS:
+        return "not enough distinct characters"
+    if long_enough and not any(ch.isalnum() for ch in normalized):
+        return "no words or numbers"
+    return None
+
+
+def _previous_turn(history):
+    """Return the user's previous message and whether that turn failed."""
+    reply = None
+    for msg in reversed(history):
+        if isinstance(msg, HumanMessage):
+            # A question with no reply, or only the error reply, counts as failed
+            return msg.content, reply is None or reply.content == ERROR_REPLY
+        if isinstance(msg, AIMessage) and reply is None:
+            reply = msg
+    return None, False
+
+
+def create_precheck():
+    """Create a node that validates the current user message locally.
+    
+    The node runs alongside the chatbot node. Raising InputRejected makes
+    LangGraph cancel the in-flight chatbot task, so the upstream LLM call
+    is abandoned instead of completing.
+    """
+    async def precheck(state: State) -> None:
+        """Reject spam, junk and repeated messages before they cost an LLM call."""
+        current = [msg for msg in state["messages"] if isinstance(msg, HumanMessage)]
+        if not current:
+            return None
+        previous, previous_failed = _previous_turn(state.get("history", []))
+        reason = check_message(current[-1].content, previous, previous_failed)
+        if reason:
+            raise InputRejected(reason)
+        return None
+    
+    return precheck
+
+
 def create_chatbot(llm):
     """Create a chatbot function with a specific LLM."""
-    def chatbot(state: State) -> State:
-        """Generate and display AI response based on conversation state."""
+    async def chatbot(state: State) -> dict:
+        """Generate an AI response and return only the new message."""
         try:
-            # Convert messages to the format LLM expects
-            messages = state["messages"]
+            # The LLM needs the full conversation: earlier turns plus this turn
+            messages = state.get("history", []) + state["messages"]
             if not messages:
                 messages = [SystemMessage(content="You are a helpful AI assistant.")]
             
-            # Get response from LLM
-            response = llm.invoke(messages)
+            # Get response from LLM; cancelled if the pre-check rejects the input
+            response = await llm.ainvoke(messages)
             
-            # Add AI response to messages
-            state["messages"].append(response)
-            return state
+            # Return only the delta; the add_messages reducer appends it
+            return {"messages": [response]}
             
         except Exception as e:
             print(f"Error in chatbot: {str(e)}")
             return {
-                "messages": state["messages"] + [AIMessage(content="I apologize, I encountered an error. Please try again.")],
-                "should_continue": state["should_continue"]
+                "messages": [AIMessage(content=ERROR_REPLY)]
             }
     
     return chatbot
@@ -60,58 +149,120 @@ def should_continue(state: State) -> str:
     return "continue" if state["should_continue"] else END
 
 
-def setup_conversation_graph(llm=None) -> StateGraph:
+def setup_conversation_graph(llm=None, precheck: bool = True) -> StateGraph:
     """Create and configure the conversation workflow graph.
     
     Args:
-        llm: The language model to use for the chatbot. If None, defaults to ChatOpenAI with 'o1' model.
+        llm: The language model to use for the chatbot. If None, defaults to an UpstreamPool of 'gpt-4' models.
+        precheck: Whether to run the local pre-check node in parallel with the chatbot.
         
     Returns:
         StateGraph: A compiled conversation workflow graph ready for execution.
     """
     if llm is None:
-        llm = ChatOpenAI(model="gpt-4")
+        llm = UpstreamPool.from_env(model="gpt-4")
         
     # Initialize the graph
     workflow = StateGraph(State)
     
     # Add chatbot node
     workflow.add_node("chatbot", create_chatbot(llm))
+    workflow.add_edge(START, "chatbot")
+    workflow.add_edge("chatbot", END)
     
-    # Set entry point
-    workflow.set_entry_point("chatbot")
+    # Fan out to the pre-check so generation starts speculatively
+    if precheck:
+        workflow.add_node("precheck", create_precheck())
+        workflow.add_edge(START, "precheck")
+        workflow.add_edge("precheck", END)
     
     return workflow.compile()
 
 
+async def arun_turn(graph, history, user_message: str) -> list:
+    """Run one conversation turn and return only the messages it added.
+
+    Args:
+        graph: A compiled conversation graph from setup_conversation_graph.
+        history: The earlier messages of the conversation. Not modified.
+        user_message: The text the user just sent.
+
+    Returns:
+        list: The new HumanMessage followed by the messages produced by the graph.
+
+    Raises:
+        InputRejected: If the pre-check node rejected the message.
+    """
+    new_messages = [HumanMessage(content=user_message)]
+    state = {
+        "history": history,
+        "messages": list(new_messages),
+        "should_continue": True
+    }
+    # "updates" mode yields each node's delta rather than the full state
+    async for update in graph.astream(state, stream_mode="updates"):
+        for node_update in update.values():
+            if node_update:
+                new_messages.extend(node_update.get("messages", []))
+    return new_messages
+
+
+# One event loop per process, shared by all synchronous callers of run_turn
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop():
+    """Return this process's long-lived event loop, starting it on first use.
+
+    Pooled upstream connections belong to the loop that opened them, so a
+    new loop per request (asyncio.run) would strand them on a closed loop.
+    The pid check gives each forked gunicorn worker its own loop thread.
+    """
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name="chatbot-event-loop", daemon=True).start()
+        return _loop
+
+
+def run_turn(graph, history, user_message: str) -> list:
+    """Synchronous wrapper around arun_turn for Flask and the CLI."""
+    future = asyncio.run_coroutine_threadsafe(arun_turn(graph, history, user_message), _event_loop())
+    return future.result()
+
+
 def main():
     """Main execution function for the chatbot."""
     # Initialize the LLM
-    llm = ChatOpenAI(model="gpt-4")
+    llm = UpstreamPool.from_env(model="gpt-4")
     
-    # Initialize conversation state
-    state = {
-        "messages": [SystemMessage(content="You are a helpful AI assistant. You are given a conversation history and a new message. You need to respond to the new message based on the conversation history. Be cheerful and friendly.")],
-        "should_continue": True
-    }
+    # Initialize conversation history
+    history = [SystemMessage(content="You are a helpful AI assistant. You are given a conversation history and a new message. You need to respond to the new message based on the conversation history. Be cheerful and friendly.")]
     
     # Create and run the conversation graph
     graph = setup_conversation_graph(llm)
     
-    while state["should_continue"]:
+    while True:
         user_input = input("\nYou: ")
         if user_input.lower() == "quit":
             break
             
-        # Add user message and get response
-        state["messages"].append(HumanMessage(content=user_input))
-        state = graph.invoke(state)
+        # Run the turn and keep only what it added
+        try:
+            new_messages = run_turn(graph, history, user_input)
+        except InputRejected as e:
+            rprint(f"\n[yellow]Message not sent ({e.reason}). Please try something else.[/yellow]")
+            continue
+        history.extend(new_messages)
         
         # Print AI response
-        if state["messages"]:
-            last_message = state["messages"][-1]
-            if isinstance(last_message, AIMessage):
-                rprint("\nAI:", last_message.content)
+        last_message = new_messages[-1]
+        if isinstance(last_message, AIMessage):
+            rprint("\nAI:", last_message.content)
     
     print("\nGoodbye!")
 
@@ -5,14 +5,14 @@
 
 # --- Import Section ---
 # Web framework and related extensions
-from flask import Flask, render_template, request, jsonify, session  # Core Flask functionality
+from flask import Flask, render_template, request, jsonify, session, abort  # Core Flask functionality
 from flask_limiter import Limiter  # For rate limiting requests
 from flask_limiter.util import get_remote_address
 from flask_talisman import Talisman  # For security headers
 
 # Chatbot related imports
-from LG_basic_chatbot import setup_conversation_graph  # Custom conversation handler
-from langchain_openai import ChatOpenAI  # OpenAI integration
+from LG_basic_chatbot import setup_conversation_graph, run_turn, InputRejected  # Custom conversation handler
+from upstream_pool import UpstreamPool  # Load-balanced pool of OpenAI keys and endpoints
 from langchain.schema import HumanMessage, AIMessage, SystemMessage  # Message types for chat
 
 # Utility imports
@@ -66,8 +66,8 @@ logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
 # Check if API key is available
-if not os.getenv("OPENAI_API_KEY"):
-    logger.error("OPENAI_API_KEY not found in environment variables")
+if not os.getenv("OPENAI_API_KEY") and not os.getenv("OPENAI_UPSTREAMS"):
+    logger.error("Neither OPENAI_API_KEY nor OPENAI_UPSTREAMS found in environment variables")
     raise ValueError("OPENAI_API_KEY not found in environment variables. Please check your .env file.")
 
 # --- Flask Application Setup ---
@@ -150,8 +150,10 @@ app.secret_key = os.getenv('FLASK_SECRET_KEY', secrets.token_hex(32))
 
 # --- Chatbot Setup ---
 # Initialize the Language Model and conversation handler
-llm = ChatOpenAI(model="gpt-4")
-graph = setup_conversation_graph(llm)
+# Calls are balanced across the configured OpenAI keys/endpoints; each one has
+# a governor shared by all workers so bursts queue instead of hitting 429s
+upstream_pool = UpstreamPool.from_env(model="gpt-4")
+graph = setup_conversation_graph(upstream_pool)
 
 # --- Helper Functions ---
 def convert_messages_for_session(messages):
@@ -202,6 +204,18 @@ def health_check():
         "environment": os.environ.get('FLASK_ENV', 'production')
     })
 
+@app.route('/admin/upstreams')
+def upstream_usage():
+    """
+    Per-upstream usage for operators, keyed by upstream name.
+    Only served when UPSTREAM_STATS_TOKEN is set and sent as a bearer token.
+    """
+    stats_token = os.environ.get('UPSTREAM_STATS_TOKEN')
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not stats_token or not secrets.compare_digest(supplied.encode(), stats_token.encode()):
+        abort(404)  # Do not reveal that the endpoint exists
+    return jsonify(upstream_pool.usage())
+
 @app.route('/')
 @limiter.limit("100/day;30/hour")  # Rate limit for homepage access
 def home():
@@ -255,27 +269,30 @@ def chat():
             return jsonify({"response": "Chat reset successfully"})
             
         # Process chat message and get response
-        messages = convert_messages_from_session(session.get('messages', []))
-        if not messages:
+        session_messages = session.get('messages', [])
+        if not session_messages:
             logger.debug("No messages in session, initializing with default")
-            messages = [SystemMessage(content="You are a mythological oracle, speaking with ancient wisdom and mystical knowledge.")]
+            session_messages = convert_messages_for_session([
+                SystemMessage(content="You are a mythological oracle, speaking with ancient wisdom and mystical knowledge.")
+            ])
+        messages = convert_messages_from_session(session_messages)
         
         logger.info(f"Processing chat message of length {len(user_message)}")
         
-        # Prepare current state and get response
-        current_state = {
-            "messages": messages + [HumanMessage(content=user_message)],
-            "should_continue": True
-        }
-        
-        result = graph.invoke(current_state)
+        # Run the turn; only the messages it added come back
+        try:
+            new_messages = run_turn(graph, messages, user_message)
+        except InputRejected as e:
+            logger.warning(f"Message rejected by pre-check: {e.reason}")
+            return jsonify({"error": "The oracle will not answer this. Please ask something else."}), 400
         
-        # Update session state
-        session['messages'] = convert_messages_for_session(result["messages"])
+        # Update session state with the new messages only
+        session_messages.extend(convert_messages_for_session(new_messages))
+        session['messages'] = session_messages
         session.modified = True
         
         # Extract and return the response
-        ai_messages = [msg for msg in result["messages"] if isinstance(msg, AIMessage)]
+        ai_messages = [msg for msg in new_messages if isinstance(msg, AIMessage)]
         if ai_messages:
             response_content = ai_messages[-1].content
             logger.debug(f"Generated response of length {len(response_content)}")
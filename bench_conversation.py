@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-turn framework overhead over a long conversation.
+
+Sends a 1,000-turn conversation through POST /chat on app.py's Flask test
+client, backed by a fake LLM, and splits each turn's time outside the LLM
+call into two parts:
+
+- graph: run_turn outside the LLM call. The chatbot node returns only the
+  new messages, so this should stay flat as the conversation grows.
+- request: everything else in the request. The whole history lives in the
+  signed session cookie, which is decoded, rebuilt into message objects by
+  convert_messages_from_session and re-encoded on every turn, so this part
+  is O(n) in the conversation length and is reported, not checked.
+
+Usage:
+    python bench_conversation.py [--turns 1000] [--bucket 100]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+import warnings
+
+# The app refuses to start without a key; the fake LLM never uses it
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-not-used")
+os.environ.setdefault("FLASK_ENV", "development")
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+import app as oracle_app
+from LG_basic_chatbot import setup_conversation_graph, run_turn
+
+BROWSER_COOKIE_LIMIT = 4093  # Bytes; browsers may drop larger cookies
+
+
+class TimedFakeLLM:
+    """Fake chat model that records how long its own calls take."""
+
+    def __init__(self):
+        self.llm = FakeListChatModel(responses=["The oracle has spoken."])
+        self.elapsed = 0.0
+
+    async def ainvoke(self, messages):
+        start = time.perf_counter()
+        try:
+            return await self.llm.ainvoke(messages)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+
+def run_benchmark(turns=1000, bucket=100):
+    """Run the conversation through /chat.
+
+    Returns the mean graph and request overhead (seconds) per bucket of
+    turns, and the final session cookie size in bytes.
+    """
+    llm = TimedFakeLLM()
+    oracle_app.graph = setup_conversation_graph(llm)
+    oracle_app.limiter.enabled = False
+    oracle_app.logger.setLevel(logging.WARNING)  # One log line per turn would dominate
+    graph_elapsed = 0.0
+
+    def timed_run_turn(*args):
+        nonlocal graph_elapsed
+        start = time.perf_counter()
+        try:
+            return run_turn(*args)
+        finally:
+            graph_elapsed += time.perf_counter() - start
+
+    oracle_app.run_turn = timed_run_turn
+    client = oracle_app.app.test_client()
+
+    graph_overheads, request_overheads = [], []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # Werkzeug warns on every oversized session cookie
+        for turn in range(turns):
+            llm_before, graph_before = llm.elapsed, graph_elapsed
+            start = time.perf_counter()
+
+            response = client.post("/chat", json={"message": f"Question number {turn}"})
+
+            total = time.perf_counter() - start
+            assert response.status_code == 200, response.get_json()
+            graph_time = graph_elapsed - graph_before
+            graph_overheads.append(graph_time - (llm.elapsed - llm_before))
+            request_overheads.append(total - graph_time)
+
+    with client.session_transaction() as session:
+        assert len(session["messages"]) == 1 + 2 * turns, "Session lost messages"
+    cookie = client.get_cookie(oracle_app.app.config["SESSION_COOKIE_NAME"])
+
+    def means(samples):
+        return [sum(samples[i:i + bucket]) / len(samples[i:i + bucket]) for i in range(0, turns, bucket)]
+
+    return means(graph_overheads), means(request_overheads), len(cookie.value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--bucket", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"Running {args.turns}-turn conversation through /chat against a fake LLM...")
+    graph_buckets, request_buckets, cookie_size = run_benchmark(args.turns, args.bucket)
+
+    print(f"\n{'Turns':>12}  {'Graph/turn':>12}  {'Request/turn':>13}")
+    for i, (graph_mean, request_mean) in enumerate(zip(graph_buckets, request_buckets)):
+        first = i * args.bucket + 1
+        last = min((i + 1) * args.bucket, args.turns)
+        print(f"{first:>5}-{last:<6}  {graph_mean * 1e6:>9.1f} µs  {request_mean * 1e6:>10.1f} µs")
+
+    print(f"\nRequest overhead (session cookie and history rebuild, O(n)): "
+          f"last/first bucket ratio {request_buckets[-1] / request_buckets[0]:.2f}")
+    if cookie_size > BROWSER_COOKIE_LIMIT:
+        print(f"Note: the final session cookie is {cookie_size:,} bytes; browsers may drop "
+              f"cookies over {BROWSER_COOKIE_LIMIT:,} bytes")
+
+    # Compare the last bucket against the first to spot linear growth in the graph
+    growth = graph_buckets[-1] / graph_buckets[0]
+    print(f"Graph overhead last/first bucket ratio: {growth:.2f}")
+    if growth < 2.0:
+        print("✓ Per-turn graph overhead is flat across the conversation")
+        return 0
+    print("✗ Per-turn graph overhead grows with conversation length")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark suite for the code that runs on every request.
+
+Measures each stage of the request hot path offline, using Flask's test
+client and a fake chat model, and reports ops/sec plus two allocation
+figures per operation: peak traced memory (KiB) and memory blocks still
+allocated afterwards. CPython has no cheap counter of every allocation,
+so peak memory stands in for allocation volume and retained blocks
+catch leaks and growing caches. Results can be saved as JSON baselines in
+bench_baselines/ and compared against later runs to catch regressions.
+
+Usage:
+    python bench_hot_path.py                      # run and print results
+    python bench_hot_path.py --save main          # store bench_baselines/main.json
+    python bench_hot_path.py --compare main       # compare against a baseline
+    python bench_hot_path.py --stage graph_turn   # run selected stages only
+"""
+
+import argparse
+import contextlib
+import datetime
+import gc
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# The app refuses to start without a key; the fake LLM never uses it
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-not-used")
+os.environ.setdefault("FLASK_ENV", "development")
+
+from flask import render_template
+from flask_talisman import Talisman
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+
+import app as app_module
+from LG_basic_chatbot import run_turn, setup_conversation_graph
+
+BASELINE_DIR = "bench_baselines"
+CONVERSATION_TURNS = 10  # Size of the conversation used by session stages
+HTTPS_BASE_URL = "https://localhost"  # Keeps production Talisman from redirecting
+
+flask_app = app_module.app
+limiter = app_module.limiter
+
+
+def sample_conversation(turns=CONVERSATION_TURNS):
+    """Build a conversation of the given number of question/answer turns."""
+    messages = [SystemMessage(content="You are a mythological oracle, speaking with ancient wisdom and mystical knowledge.")]
+    for turn in range(turns):
+        messages.append(HumanMessage(content=f"What does omen number {turn} foretell?"))
+        messages.append(AIMessage(content="The threads of fate are woven tightly, seeker. " * 3))
+    return messages
+
+
+_ip_counter = itertools.count()
+
+
+def unique_client_ip():
+    """Return a fresh client address so per-IP rate limits are never hit."""
+    n = next(_ip_counter)
+    return f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+
+@contextlib.contextmanager
+def limiter_enabled(enabled):
+    """Temporarily switch rate limiting on or off."""
+    previous = limiter.enabled
+    limiter.enabled = enabled
+    try:
+        yield
+    finally:
+        limiter.enabled = previous
+
+
+@contextlib.contextmanager
+def talisman_enabled(enabled):
+    """Temporarily detach Talisman's request hooks from the app."""
+    if enabled:
+        yield
+        return
+    hooks = {}
+    for registry in (flask_app.before_request_funcs, flask_app.after_request_funcs):
+        funcs = registry.get(None, [])
+        hooks[id(registry)] = list(funcs)
+        funcs[:] = [f for f in funcs if not isinstance(getattr(f, "__self__", None), Talisman)]
+    try:
+        yield
+    finally:
+        for registry in (flask_app.before_request_funcs, flask_app.after_request_funcs):
+            registry.get(None, [])[:] = hooks[id(registry)]
+
+
+# --- Stages ---
+# Each stage builder does its setup once and returns a zero-argument callable
+# that performs one operation, plus the context it must run under.
+
+def stage_session_to_dicts():
+    messages = sample_conversation()
+    return lambda: app_module.convert_messages_for_session(messages), contextlib.nullcontext()
+
+
+def stage_session_from_dicts():
+    stored = app_module.convert_messages_for_session(sample_conversation())
+    return lambda: app_module.convert_messages_from_session(stored), contextlib.nullcontext()
+
+
+def stage_cookie_dumps():
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    data = {"messages": app_module.convert_messages_for_session(sample_conversation())}
+    return lambda: serializer.dumps(data), contextlib.nullcontext()
+
+
+def stage_cookie_loads():
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    cookie = serializer.dumps({"messages": app_module.convert_messages_for_session(sample_conversation())})
+    return lambda: serializer.loads(cookie), contextlib.nullcontext()
+
+
+def stage_graph_turn():
+    graph = setup_conversation_graph(FakeListChatModel(responses=["The oracle has spoken."]))
+    history = sample_conversation()
+    return lambda: run_turn(graph, history, "Will the harvest be kind?"), contextlib.nullcontext()
+
+
+def stage_render_template():
+    def render():
+        with flask_app.test_request_context("/", base_url=HTTPS_BASE_URL):
+            return render_template("chatbot.html")
+    return render, contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def request_features(limited, secured):
+    """Run requests with the limiter and Talisman switched on or off."""
+    with limiter_enabled(limited), talisman_enabled(secured):
+        yield
+
+
+def _health_request(limited, secured):
+    client = flask_app.test_client()
+
+    def request():
+        response = client.get("/health", base_url=HTTPS_BASE_URL,
+                              environ_base={"REMOTE_ADDR": unique_client_ip()})
+        assert response.status_code == 200, response.status_code
+    return request, request_features(limited, secured)
+
+
+def stage_request_bare():
+    return _health_request(limited=False, secured=False)
+
+
+def stage_request_limiter():
+    return _health_request(limited=True, secured=False)
+
+
+def stage_request_talisman():
+    return _health_request(limited=False, secured=True)
+
+
+def stage_chat_endpoint():
+    app_module.graph = setup_conversation_graph(FakeListChatModel(responses=["The oracle has spoken."]))
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    cookie = serializer.dumps({"messages": app_module.convert_messages_for_session(sample_conversation())})
+    client = flask_app.test_client(use_cookies=False)
+    cookie_name = flask_app.config["SESSION_COOKIE_NAME"]
+
+    def request():
+        # Send the same stored conversation each time so the session does not grow
+        response = client.post("/chat", base_url=HTTPS_BASE_URL,
+                               json={"message": "Will the harvest be kind?"},
+                               headers={"Cookie": f"{cookie_name}={cookie}"},
+                               environ_base={"REMOTE_ADDR": unique_client_ip()})
+        assert response.status_code == 200, response.get_json()
+    return request, contextlib.nullcontext()
+
+
+STAGES = {
+    "session_to_dicts": stage_session_to_dicts,
+    "session_from_dicts": stage_session_from_dicts,
+    "cookie_dumps": stage_cookie_dumps,
+    "cookie_loads": stage_cookie_loads,
+    "graph_turn": stage_graph_turn,
+    "render_template": stage_render_template,
+    "request_bare": stage_request_bare,
+    "request_limiter": stage_request_limiter,
+    "request_talisman": stage_request_talisman,
+    "chat_endpoint": stage_chat_endpoint,
+}
+
+# Derived per-request overheads: (name, stage with the feature, stage without)
+OVERHEADS = [
+    ("limiter_overhead_us", "request_limiter", "request_bare"),
+    ("talisman_overhead_us", "request_talisman", "request_bare"),
+]
+
+
+# --- Measurement ---
+
+def measure(fn, min_time=0.5, rounds=5, alloc_samples=20):
+    """Return ops/sec (best of several rounds), peak KiB and retained blocks per op."""
+    # Warm up caches, lazy imports and template compilation
+    for _ in range(3):
+        fn()
+
+    # Calibrate a batch size that takes roughly min_time / rounds
+    batch = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(batch):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / rounds or batch >= 1_000_000:
+            break
+        batch *= 2
+
+    best = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(batch):
+            fn()
+        best = max(best, batch / (time.perf_counter() - start))
+
+    # Allocation profile is taken separately; tracemalloc slows everything down
+    tracemalloc.start()
+    peaks = []
+    try:
+        for _ in range(alloc_samples):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            fn()
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    # Blocks that survive a collection after the ops were run
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    for _ in range(alloc_samples):
+        fn()
+    gc.collect()
+    retained = (sys.getallocatedblocks() - blocks_before) / alloc_samples
+
+    return {
+        "ops_per_sec": round(best, 1),
+        "peak_kib_per_op": round(sorted(peaks)[len(peaks) // 2] / 1024, 2),
+        "retained_blocks_per_op": round(retained, 1),
+    }
+
+
+def run_stages(names, min_time):
+    """Run the named stages and return their results plus derived overheads."""
+    results = {}
+    for name in names:
+        fn, context = STAGES[name]()
+        with context:
+            results[name] = measure(fn, min_time=min_time)
+        print(f"  {name:<20} {results[name]['ops_per_sec']:>12,.1f} ops/s"
+              f"  {results[name]['peak_kib_per_op']:>9.2f} KiB/op"
+              f"  {results[name]['retained_blocks_per_op']:>8.1f} blocks/op")
+
+    overheads = {}
+    for label, with_feature, without in OVERHEADS:
+        if with_feature in results and without in results:
+            per_op = 1 / results[with_feature]["ops_per_sec"] - 1 / results[without]["ops_per_sec"]
+            overheads[label] = round(per_op * 1e6, 1)
+    return results, overheads
+
+
+# --- Baselines ---
+
+def git_commit():
+    """Return the current commit hash, or None outside a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def save_baseline(name, results, overheads):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    payload = {
+        "meta": {
+            "commit": git_commit(),
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "environment": os.environ.get("FLASK_ENV"),
+        },
+        "stages": results,
+        "overheads": overheads,
+    }
+    with open(baseline_path(name), "w") as f:
+        json.dump(payload, f, indent=2, sort_keys=True)
+    print(f"\nSaved baseline to {baseline_path(name)}")
+
+
+def compare_baseline(name, results, threshold):
+    """Print changes against a stored baseline; return True if any stage regressed."""
+    with open(baseline_path(name)) as f:
+        baseline = json.load(f)
+    print(f"\nComparison with {name} (commit {baseline['meta'].get('commit')}):")
+    regressed = False
+    for stage, current in results.items():
+        previous = baseline["stages"].get(stage)
+        if previous is None:
+            print(f"  {stage:<20} (no baseline)")
+            continue
+        speed = current["ops_per_sec"] / previous["ops_per_sec"] - 1
+        memory = current["peak_kib_per_op"] - previous["peak_kib_per_op"]
+        blocks = current["retained_blocks_per_op"] - previous.get("retained_blocks_per_op", 0.0)
+        slower = speed < -threshold
+        regressed = regressed or slower
+        print(f"  {'✗' if slower else '✓'} {stage:<20} {speed:>+8.1%} ops/s  {memory:>+9.2f} KiB/op"
+              f"  {blocks:>+8.1f} blocks/op")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--stage", action="append", choices=sorted(STAGES),
+                        help="Stage to run (repeatable); defaults to all stages")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="Approximate seconds spent timing each stage")
+    parser.add_argument("--save", metavar="NAME", help="Save results as a named baseline")
+    parser.add_argument("--compare", metavar="NAME", help="Compare results with a named baseline")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="Fractional ops/sec drop counted as a regression")
+    args = parser.parse_args()
+
+    # Per-request log lines would dominate the timings
+    app_module.logger.setLevel(logging.WARNING)
+
+    print(f"Running hot path benchmarks ({os.environ.get('FLASK_ENV')} configuration)...")
+    results, overheads = run_stages(args.stage or list(STAGES), args.min_time)
+    for label, value in overheads.items():
+        print(f"  {label:<20} {value:>12,.1f} µs/request")
+
+    if args.save:
+        save_baseline(args.save, results, overheads)
+    if args.compare:
+        if compare_baseline(args.compare, results, args.threshold):
+            print("\n✗ Performance regression detected")
+            return 1
+        print("\n✓ No regressions beyond threshold")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+A local stand-in for the OpenAI chat completions API, used by tests.
+
+The server answers POST /v1/chat/completions with a canned reply and
+enforces a requests-per-second limit the way OpenAI does: successful
+responses carry x-ratelimit-* headers and requests over the limit get a
+429 with retry-after-ms. No network access or API key is needed.
+"""
+
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIServer:
+    """Rate-limited fake OpenAI endpoint running in a background thread.
+
+    Args:
+        requests_per_second: Requests allowed in any sliding one-second window.
+        tokens_per_minute: Token limit reported in the x-ratelimit-*-tokens headers.
+        latency: Seconds each successful completion takes.
+        reply: Content of the assistant message returned on success.
+        fail_status: If set, every request fails with this HTTP status.
+    """
+
+    def __init__(self, requests_per_second=10, tokens_per_minute=1_000_000, latency=0.05,
+                 reply="The oracle has spoken.", fail_status=None):
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self.latency = latency
+        self.reply = reply
+        self.fail_status = fail_status
+        self.served = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self.api_keys = collections.Counter()
+        self._window = collections.deque()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        """Base URL to pass to the OpenAI client."""
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _admit(self):
+        """Record a request; return (allowed, remaining, reset seconds)."""
+        with self._lock:
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= 1.0:
+                self._window.popleft()
+            reset = 1.0 - (now - self._window[0]) if self._window else 0.0
+            if len(self._window) >= self.requests_per_second:
+                self.rate_limited += 1
+                return False, 0, reset
+            self._window.append(now)
+            return True, self.requests_per_second - len(self._window), reset or 1.0
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive like the real API, so pooled client connections are reused
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass  # Keep test output readable
+
+            def _send(self, status, body, headers):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                api_key = self.headers.get("Authorization", "").removeprefix("Bearer ")
+                with fake._lock:
+                    fake.api_keys[api_key] += 1
+
+                if not self.path.endswith("/chat/completions"):
+                    self._send(404, {"error": {"message": "Not found"}}, {})
+                    return
+                if fake.fail_status:
+                    with fake._lock:
+                        fake.failed += 1
+                    self._send(fake.fail_status, {"error": {"message": "Upstream unavailable"}}, {})
+                    return
+
+                allowed, remaining, reset = fake._admit()
+                headers = {
+                    "x-ratelimit-limit-requests": str(fake.requests_per_second * 60),
+                    "x-ratelimit-remaining-requests": str(remaining),
+                    "x-ratelimit-reset-requests": f"{int(reset * 1000)}ms",
+                    "x-ratelimit-limit-tokens": str(fake.tokens_per_minute),
+                    # Every completion uses 15 tokens; see "usage" below
+                    "x-ratelimit-remaining-tokens": str(fake.tokens_per_minute - 15 * len(fake._window)),
+                    "x-ratelimit-reset-tokens": f"{int(reset * 1000)}ms",
+                }
+                if not allowed:
+                    headers["retry-after-ms"] = str(max(1, int(reset * 1000)))
+                    self._send(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                               "code": "rate_limit_exceeded"}}, headers)
+                    return
+
+                time.sleep(fake.latency)
+                with fake._lock:
+                    fake.served += 1
+                self._send(200, {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "gpt-4"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": fake.reply},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+                }, headers)
+
+        return Handler
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import time
+
+# The chatbot module refuses to load without a key; the fake LLM never uses it
+os.environ.setdefault("OPENAI_API_KEY", "sk-test-not-used")
+
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+
+from LG_basic_chatbot import ERROR_REPLY, InputRejected, check_message, run_turn, setup_conversation_graph
+
+
+class SlowFakeLLM:
+    """Fake chat model that takes a while to answer and records cancellation"""
+
+    def __init__(self, delay=1.0):
+        self.delay = delay
+        self.started = 0
+        self.cancelled = 0
+
+    async def ainvoke(self, messages):
+        self.started += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return AIMessage(content="The oracle has spoken.")
+
+
+def test_check_message():
+    """Test the local spam and junk heuristics"""
+    print("\nTesting message checks...")
+    cases = [
+        ("What does the future hold?", None, False, None),
+        ("What does the future hold?", "what  does the FUTURE hold?", False, "repeated message"),
+        # Resending after a failed turn is a retry, not spam
+        ("What does the future hold?", "What does the future hold?", True, None),
+        # Short replies may legitimately repeat or lack words
+        ("yes", "yes", False, None),
+        ("?", None, False, None),
+        ("👍", None, False, None),
+        ("http://a.com http://b.com http://c.com", None, False, "too many links"),
+        ("Hello" + "!" * 25, None, False, "repeated characters"),
+        ("ab " * 10, None, False, "not enough distinct characters"),
+        ("?!?! ... ??? ?!?! ... ???", None, False, "no words or numbers"),
+    ]
+    for text, previous, previous_failed, expected in cases:
+        reason = check_message(text, previous, previous_failed)
+        print(f"{'✓' if reason == expected else '✗'} {text[:30]!r}: {reason}")
+        assert reason == expected
+
+
+def test_accepted_message_gets_reply():
+    """Test that a normal message runs through both branches and gets an answer"""
+    print("\nTesting accepted message...")
+    llm = SlowFakeLLM(delay=0.01)
+    graph = setup_conversation_graph(llm)
+    history = [SystemMessage(content="You are an oracle.")]
+
+    new_messages = run_turn(graph, history, "Will it rain tomorrow?")
+
+    assert [type(msg) for msg in new_messages] == [HumanMessage, AIMessage]
+    assert llm.cancelled == 0
+    print("✓ Reply received without cancellation")
+
+
+def test_retry_after_error_reply_is_accepted():
+    """Test that resending a question after the error reply reaches the LLM"""
+    print("\nTesting retry after an error reply...")
+    llm = SlowFakeLLM(delay=0.01)
+    graph = setup_conversation_graph(llm)
+    history = [
+        SystemMessage(content="You are an oracle."),
+        HumanMessage(content="Will it rain tomorrow?"),
+        AIMessage(content=ERROR_REPLY),
+    ]
+
+    new_messages = run_turn(graph, history, "Will it rain tomorrow?")
+
+    assert new_messages[-1].content == "The oracle has spoken."
+    print("✓ Retried question was answered")
+
+
+def test_rejected_message_cancels_llm_call():
+    """Test that a rejected message cancels the speculative LLM call"""
+    print("\nTesting rejected message...")
+    llm = SlowFakeLLM(delay=2.0)
+    graph = setup_conversation_graph(llm)
+    history = [
+        SystemMessage(content="You are an oracle."),
+        HumanMessage(content="Will it rain tomorrow?"),
+        AIMessage(content="The clouds are undecided."),
+    ]
+
+    start = time.perf_counter()
+    try:
+        run_turn(graph, history, "Will it rain tomorrow?")
+    except InputRejected as e:
+        elapsed = time.perf_counter() - start
+        print(f"✓ Rejected ({e.reason}) after {elapsed:.2f}s")
+    else:
+        raise AssertionError("Repeated message was not rejected")
+
+    assert llm.started == 1, "Generation should start speculatively"
+    assert llm.cancelled == 1, "Upstream call should be cancelled"
+    assert elapsed < llm.delay, "Rejection should not wait for the LLM"
+    print("✓ Speculative LLM call was cancelled")
+
+
+if __name__ == "__main__":
+    print("Starting pre-check tests...")
+    test_check_message()
+    test_accepted_message_gets_reply()
+    test_retry_after_error_reply_is_accepted()
+    test_rejected_message_cancels_llm_call()
+    print("\nAll pre-check tests passed")
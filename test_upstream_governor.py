@@ -0,0 +1,223 @@
+import asyncio
+import os
+import tempfile
+import time
+
+# The chatbot module refuses to load without a key; requests go to the fake server
+os.environ.setdefault("OPENAI_API_KEY", "sk-test-not-used")
+
+from langchain.schema import AIMessage
+from langchain_openai import ChatOpenAI
+
+from fake_openai_server import FakeOpenAIServer
+from LG_basic_chatbot import ERROR_REPLY as APOLOGY, arun_turn, run_turn, setup_conversation_graph
+from upstream_governor import GovernorTimeout, UpstreamGovernor, create_governed_llm, parse_duration
+
+
+# Removed with everything in it when the test run ends
+STORE_DIR = tempfile.TemporaryDirectory(prefix="governor-tests-")
+
+
+def make_governor(**kwargs):
+    """Create a governor backed by a fresh store file."""
+    fd, store_path = tempfile.mkstemp(suffix=".sqlite3", dir=STORE_DIR.name)
+    os.close(fd)
+    return UpstreamGovernor(store_path=store_path, **kwargs)
+
+
+async def run_burst(llm, count):
+    """Send count conversations at once and return the AI replies."""
+    graph = setup_conversation_graph(llm, precheck=False)
+    results = await asyncio.gather(*[arun_turn(graph, [], f"Question {i}") for i in range(count)])
+    return [messages[-1].content for messages in results if isinstance(messages[-1], AIMessage)]
+
+
+def test_parse_duration():
+    """Test parsing of OpenAI reset durations"""
+    print("\nTesting duration parsing...")
+    assert parse_duration("20ms") == 0.02
+    assert parse_duration("1s") == 1
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("1h2m3.5s") == 3723.5
+    assert parse_duration("2") == 2
+    assert parse_duration("soon") is None
+    print("✓ Durations parsed")
+
+
+def test_aimd_concurrency():
+    """Test that 429s halve the concurrency limit and successes grow it back"""
+    print("\nTesting AIMD concurrency...")
+    governor = make_governor(max_concurrency=8)
+    governor.observe(429, {"retry-after-ms": "10"})
+    assert governor.stats()["concurrency_limit"] == 4
+    governor.observe(429, {"retry-after-ms": "10"})
+    assert governor.stats()["concurrency_limit"] == 2
+    for _ in range(10):
+        governor.observe(200, {})
+    limit = governor.stats()["concurrency_limit"]
+    assert 4 < limit < 8, limit
+    print(f"✓ Limit went 8 → 4 → 2 → {limit} after 10 successes")
+
+
+def test_headers_pause_bucket():
+    """Test that rate limit headers are learned and exhausted budgets pause calls"""
+    print("\nTesting rate limit headers...")
+    governor = make_governor(requests_per_minute=60)
+    governor.observe(200, {
+        "x-ratelimit-limit-requests": "600",
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "500ms",
+    })
+    stats = governor.stats()
+    assert stats["requests_per_minute"] == 600
+    assert 0.4 < stats["paused_for"] <= 0.5
+    slot_id, wait = governor.try_acquire()
+    assert slot_id is None and wait > 0.4
+    print(f"✓ Learned 600 RPM and paused for {stats['paused_for']}s")
+
+
+def test_token_budget():
+    """Test that estimated token costs are charged, learned limits apply and usage settles"""
+    print("\nTesting token budget...")
+    governor = make_governor(tokens_per_minute=600)  # 10 tokens/s, bucket of 100
+    first, _ = governor.try_acquire(cost=80)
+    second, wait = governor.try_acquire(cost=80)
+    assert first and second is None and wait > 5, wait
+    governor.release(first)
+    print(f"✓ Second 80-token call must wait {wait:.1f}s")
+
+    governor.settle(estimated=80, actual=15)
+    assert governor.stats()["token_budget"] >= 85
+    print("✓ Unused estimate refunded after the real usage was known")
+
+    governor.observe(200, {"x-ratelimit-limit-tokens": "60000", "x-ratelimit-remaining-tokens": "50"})
+    stats = governor.stats()
+    assert stats["tokens_per_minute"] == 60000 and stats["token_budget"] <= 55
+    print(f"✓ Learned {stats['tokens_per_minute']:.0f} TPM and remaining budget from headers")
+
+
+def test_failed_attempts_refund_tokens():
+    """Test that rate-limited and failed attempts give their token estimate back"""
+    print("\nTesting token refunds for failed attempts...")
+    governor = make_governor(tokens_per_minute=600, queue_timeout=5)  # Bucket of 100 tokens
+    attempts = []
+
+    class RateLimited(Exception):
+        status_code = 429
+
+    async def flaky():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise RateLimited()
+        return "ok"
+
+    async def broken():
+        raise ValueError("upstream exploded")
+
+    try:
+        asyncio.run(governor.call(broken, cost=80))
+    except ValueError:
+        pass
+    # Without refunds three 80-token attempts would need 14s of refill, past the timeout
+    assert asyncio.run(governor.call(flaky, cost=80)) == "ok"
+    assert len(attempts) == 3
+    # Only the successful attempt's 80 tokens are still charged
+    assert governor.stats()["token_budget"] >= 20
+    print(f"✓ {len(attempts) - 1} retried attempts and 1 failed call were refunded")
+
+
+def test_shared_store_across_instances():
+    """Test that two governors on the same store share one concurrency budget"""
+    print("\nTesting shared store...")
+    first = make_governor(max_concurrency=1, queue_timeout=0.2)
+    second = UpstreamGovernor(store_path=first.store_path, max_concurrency=1, queue_timeout=0.2)
+
+    async def hold_and_contend():
+        async with first.slot():
+            try:
+                async with second.slot():
+                    return False
+            except GovernorTimeout:
+                return True
+
+    assert asyncio.run(hold_and_contend()), "Second worker should have to wait"
+    print("✓ Second worker queued behind the first")
+
+
+def test_cancelled_wait_releases_slot():
+    """Test that cancelling a queued call does not leak its slot or block the loop"""
+    print("\nTesting cancellation while queued...")
+    governor = make_governor(max_concurrency=1, queue_timeout=5)
+
+    async def scenario():
+        async with governor.slot():
+            waiter = asyncio.create_task(governor.call(lambda: asyncio.sleep(0)))
+            ticks = 0
+            for _ in range(10):  # The loop keeps running while the waiter polls the store
+                await asyncio.sleep(0.01)
+                ticks += 1
+            waiter.cancel()
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                pass
+            return ticks
+
+    assert asyncio.run(scenario()) == 10
+    time.sleep(0.1)  # Let any abandoned acquire finish and release
+    assert governor.stats()["in_flight"] == 0
+    print("✓ Cancelled waiter left no slot behind")
+
+
+def test_burst_against_rate_limited_server():
+    """Test a burst against a fake server enforcing 5 requests per second"""
+    print("\nTesting burst against rate-limited fake server...")
+    with FakeOpenAIServer(requests_per_second=5) as server:
+        # Without the governor many calls are rejected and end in an apology
+        plain = ChatOpenAI(model="gpt-4", base_url=server.base_url, api_key="sk-fake", max_retries=0)
+        start = time.perf_counter()
+        replies = asyncio.run(run_burst(plain, 20))
+        ungoverned_429s = server.rate_limited
+        print(f"  Ungoverned: {replies.count(APOLOGY)} apologies, {ungoverned_429s} 429s "
+              f"in {time.perf_counter() - start:.2f}s")
+        assert APOLOGY in replies
+        time.sleep(1.0)  # Let the server's window drain
+
+        governor = make_governor(requests_per_minute=300, max_concurrency=8, queue_timeout=10)
+        governed = create_governed_llm(governor, model="gpt-4", base_url=server.base_url, api_key="sk-fake")
+        start = time.perf_counter()
+        replies = asyncio.run(run_burst(governed, 20))
+        governed_429s = server.rate_limited - ungoverned_429s
+        print(f"  Governed: {replies.count(APOLOGY)} apologies, {governed_429s} 429s "
+              f"in {time.perf_counter() - start:.2f}s")
+
+    assert replies == ["The oracle has spoken."] * 20, "Every governed request should succeed"
+    assert governed_429s < ungoverned_429s
+    print("✓ Governor queued the burst instead of failing it")
+
+
+def test_sequential_turns_reuse_connections():
+    """Test several sequential run_turn calls over keep-alive connections"""
+    print("\nTesting sequential turns over keep-alive connections...")
+    with FakeOpenAIServer() as server:
+        governed = create_governed_llm(make_governor(), model="gpt-4", base_url=server.base_url,
+                                       api_key="sk-fake")
+        graph = setup_conversation_graph(governed, precheck=False)
+        replies = [run_turn(graph, [], f"Question {i}")[-1].content for i in range(4)]
+
+    assert replies == ["The oracle has spoken."] * 4, replies
+    print("✓ All 4 sequential turns answered")
+
+
+if __name__ == "__main__":
+    print("Starting upstream governor tests...")
+    test_parse_duration()
+    test_aimd_concurrency()
+    test_headers_pause_bucket()
+    test_token_budget()
+    test_failed_attempts_refund_tokens()
+    test_shared_store_across_instances()
+    test_cancelled_wait_releases_slot()
+    test_burst_against_rate_limited_server()
+    test_sequential_turns_reuse_connections()
+    print("\nAll upstream governor tests passed")
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+# The chatbot module refuses to load without a key; requests go to the fake servers
+os.environ.setdefault("OPENAI_API_KEY", "sk-test-not-used")
+
+from langchain.schema import HumanMessage
+
+from fake_openai_server import FakeOpenAIServer
+from upstream_pool import NoHealthyUpstream, UpstreamPool
+
+
+# Removed with everything in it when the test run ends
+STORE_DIR = tempfile.TemporaryDirectory(prefix="pool-tests-")
+
+
+def make_pool(servers, weights=None, store_path=None, **pool_kwargs):
+    """Build a pool with one upstream per fake server, each with its own key."""
+    if store_path is None:
+        fd, store_path = tempfile.mkstemp(suffix=".sqlite3", dir=STORE_DIR.name)
+        os.close(fd)
+    configs = [
+        {"name": f"key-{i}", "api_key": f"sk-fake-{i}", "base_url": server.base_url,
+         "weight": (weights or [1] * len(servers))[i]}
+        for i, server in enumerate(servers)
+    ]
+    return UpstreamPool.from_configs(configs, store_path=store_path, **pool_kwargs)
+
+
+async def burst(pool, count):
+    """Send count calls to the pool at once and return the replies."""
+    responses = await asyncio.gather(*[
+        pool.ainvoke([HumanMessage(content=f"Question {i}")]) for i in range(count)
+    ])
+    return [response.content for response in responses]
+
+
+def test_weighted_balancing():
+    """Test that concurrent calls are spread in proportion to weight"""
+    print("\nTesting weighted least-outstanding-requests balancing...")
+    with FakeOpenAIServer(requests_per_second=100, latency=0.2) as heavy, \
+            FakeOpenAIServer(requests_per_second=100, latency=0.2) as light:
+        # A long failover wait keeps queued calls on the key they were balanced to
+        pool = make_pool([heavy, light], weights=[3, 1], failover_wait=30)
+        replies = asyncio.run(burst(pool, 40))
+
+    assert replies == ["The oracle has spoken."] * 40
+    usage = pool.usage()
+    print(f"  key-0 (weight 3): {usage['key-0']['requests']} requests, "
+          f"key-1 (weight 1): {usage['key-1']['requests']} requests")
+    assert usage["key-0"]["requests"] == 30 and usage["key-1"]["requests"] == 10
+    assert heavy.api_keys["sk-fake-0"] == 30 and light.api_keys["sk-fake-1"] == 10
+    assert usage["key-0"]["tokens"] == 30 * 15
+    print("✓ Calls split 3:1 with per-key usage reported")
+
+
+def test_weighted_balancing_sequential():
+    """Test that one-at-a-time calls, as in a sync worker, still follow the weights"""
+    print("\nTesting weighted balancing of sequential calls...")
+
+    async def one_at_a_time(pool, count):
+        for i in range(count):
+            await pool.ainvoke([HumanMessage(content=f"Question {i}")])
+
+    with FakeOpenAIServer(requests_per_second=1000, latency=0) as heavy, \
+            FakeOpenAIServer(requests_per_second=1000, latency=0) as light:
+        pool = make_pool([heavy, light], weights=[3, 1])
+        asyncio.run(one_at_a_time(pool, 100))
+
+    usage = pool.usage()
+    print(f"  key-0 (weight 3): {usage['key-0']['requests']} requests, "
+          f"key-1 (weight 1): {usage['key-1']['requests']} requests")
+    assert usage["key-0"]["requests"] + usage["key-1"]["requests"] == 100
+    assert 60 <= usage["key-0"]["requests"] <= 90, usage
+    print("✓ Sequential calls split roughly 3:1")
+
+
+def test_unhealthy_upstream_is_ejected_and_readmitted():
+    """Test failover, ejection of a failing key, and re-admission after recovery"""
+    print("\nTesting ejection and re-admission...")
+    with FakeOpenAIServer() as healthy, FakeOpenAIServer(fail_status=503) as broken:
+        pool = make_pool([healthy, broken], failure_threshold=2, ejection_seconds=3)
+
+        replies = asyncio.run(burst(pool, 10))
+        assert replies == ["The oracle has spoken."] * 10, "Failures should fail over"
+        usage = pool.usage()["key-1"]
+        assert usage["worker"]["ejected"] and usage["ejections"] == 1
+        assert usage["last_error"] == "InternalServerError (503)"
+        print(f"✓ Broken key ejected after {usage['failures']} failures; all calls succeeded")
+
+        # While ejected, the broken key gets no traffic
+        sent = broken.api_keys["sk-fake-1"]
+        asyncio.run(burst(pool, 5))
+        assert broken.api_keys["sk-fake-1"] == sent
+        print("✓ Ejected key received no traffic")
+
+        # Once the upstream recovers and the ejection expires, it is used again
+        broken.fail_status = None
+        time.sleep(3.1)
+        asyncio.run(burst(pool, 10))
+        usage = pool.usage()["key-1"]
+        assert not usage["worker"]["ejected"] and usage["successes"] > 0
+        print(f"✓ Recovered key re-admitted and served {usage['successes']} calls")
+
+
+def test_all_upstreams_down():
+    """Test that a call fails cleanly when every upstream is broken"""
+    print("\nTesting all upstreams down...")
+    with FakeOpenAIServer(fail_status=500) as first, FakeOpenAIServer(fail_status=502) as second:
+        pool = make_pool([first, second])
+        try:
+            asyncio.run(pool.ainvoke([HumanMessage(content="Hello")]))
+        except NoHealthyUpstream as e:
+            print(f"✓ Raised {type(e).__name__}: {e}")
+        else:
+            raise AssertionError("Expected NoHealthyUpstream")
+
+
+def test_saturated_upstream_fails_over_quickly():
+    """Test that a saturated key hands off to a healthy one instead of queueing"""
+    print("\nTesting failover from a saturated upstream...")
+    with FakeOpenAIServer() as busy, FakeOpenAIServer() as idle:
+        pool = make_pool([busy, idle], failover_wait=0.2, timeout=5)
+        # The busy key was just told to back off for 5 seconds
+        pool.upstreams[0].llm.governor.observe(429, {"retry-after-ms": "5000"})
+        pool.upstreams[1].outstanding = 1  # Make the busy key the first pick
+
+        start = time.perf_counter()
+        reply = asyncio.run(pool.ainvoke([HumanMessage(content="Hello")]))
+        elapsed = time.perf_counter() - start
+
+    assert reply.content == "The oracle has spoken."
+    assert elapsed < 1.0, f"Failover took {elapsed:.2f}s"
+    print(f"✓ Failed over to the idle key after {elapsed:.2f}s")
+    usage = pool.usage()
+    # Only the 429 above reached the busy key; the timed-out wait sent nothing
+    assert usage["key-0"]["requests"] == 1 and usage["key-1"]["requests"] == 1, usage
+    print("✓ Only requests that were sent are counted")
+
+
+def test_usage_store_errors_do_not_fail_calls():
+    """Test that a failing usage write is logged instead of failing the call"""
+    print("\nTesting best-effort usage recording...")
+
+    def locked(**counts):
+        raise sqlite3.OperationalError("database is locked")
+
+    with FakeOpenAIServer() as server:
+        pool = make_pool([server])
+        pool.upstreams[0].governor.record_usage = locked
+        reply = asyncio.run(pool.ainvoke([HumanMessage(content="Hello")]))
+
+    assert reply.content == "The oracle has spoken."
+    print("✓ Call succeeded although usage could not be recorded")
+
+
+def test_queue_timeout_bounds_each_attempt():
+    """Test that a paused upstream gives up after its governor's queue timeout"""
+    print("\nTesting per-upstream queue timeout...")
+    with FakeOpenAIServer() as busy:
+        pool = make_pool([busy], timeout=30)
+        governor = pool.upstreams[0].governor
+        governor.queue_timeout = 0.3
+        governor.observe(429, {"retry-after-ms": "5000"})
+
+        start = time.perf_counter()
+        try:
+            asyncio.run(pool.ainvoke([HumanMessage(content="Hello")]))
+        except NoHealthyUpstream:
+            elapsed = time.perf_counter() - start
+        else:
+            raise AssertionError("Expected NoHealthyUpstream")
+
+    assert elapsed < 1.0, f"Gave up after {elapsed:.2f}s"
+    print(f"✓ Gave up after {elapsed:.2f}s instead of the 30s pool timeout")
+
+
+def test_usage_is_shared_across_workers():
+    """Test that pools in different workers report the same combined usage"""
+    print("\nTesting usage shared across workers...")
+    with FakeOpenAIServer() as server:
+        first = make_pool([server])
+        second = make_pool([server], store_path=first.upstreams[0].governor.store_path)
+        asyncio.run(burst(first, 3))
+        asyncio.run(burst(second, 2))
+
+    for pool in (first, second):
+        usage = pool.usage()["key-0"]
+        assert usage["requests"] == usage["successes"] == 5 and usage["tokens"] == 5 * 15, usage
+        assert usage["in_flight"] == 0 and usage["worker"]["outstanding"] == 0
+    print("✓ Both workers report 5 requests across the shared store")
+
+
+def test_from_env_reads_upstream_list():
+    """Test building the pool from OPENAI_UPSTREAMS"""
+    print("\nTesting OPENAI_UPSTREAMS configuration...")
+    os.environ["OPENAI_TEST_KEY_2"] = "sk-from-env"
+    os.environ["UPSTREAM_GOVERNOR_DB"] = os.path.join(STORE_DIR.name, "from_env.sqlite3")
+    os.environ["OPENAI_UPSTREAMS"] = json.dumps([
+        {"name": "primary", "api_key": "sk-inline", "weight": 2},
+        {"name": "secondary", "api_key_env": "OPENAI_TEST_KEY_2", "base_url": "http://127.0.0.1:1/v1"},
+    ])
+    try:
+        pool = UpstreamPool.from_env()
+    finally:
+        del os.environ["OPENAI_UPSTREAMS"], os.environ["UPSTREAM_GOVERNOR_DB"]
+    assert [(u.name, u.weight) for u in pool.upstreams] == [("primary", 2.0), ("secondary", 1.0)]
+    assert pool.upstreams[1].llm.chat_kwargs["api_key"] == "sk-from-env"
+    print("✓ Pool built from OPENAI_UPSTREAMS")
+
+
+if __name__ == "__main__":
+    print("Starting upstream pool tests...")
+    test_weighted_balancing()
+    test_weighted_balancing_sequential()
+    test_unhealthy_upstream_is_ejected_and_readmitted()
+    test_all_upstreams_down()
+    test_saturated_upstream_fails_over_quickly()
+    test_usage_store_errors_do_not_fail_calls()
+    test_queue_timeout_bounds_each_attempt()
+    test_usage_is_shared_across_workers()
+    test_from_env_reads_upstream_list()
+    print("\nAll upstream pool tests passed")
@@ -0,0 +1,422 @@
+"""
+Client-side rate governor for upstream LLM calls.
+
+Every gunicorn worker talks to OpenAI on its own, so a burst of traffic
+can exceed the organisation's rate limits and turn into a wave of 429s.
+The governor sits in front of each LLM call and coordinates all workers
+on the host through a small SQLite file:
+
+- token buckets pace requests and estimated LLM tokens to the learned
+  requests-per-minute and tokens-per-minute limits; estimates are
+  corrected with the usage each response reports
+- an AIMD concurrency limit grows by one slot per window of successful
+  calls and halves on every 429
+- x-ratelimit-* and retry-after headers pause the bucket until the
+  upstream window resets
+- callers wait in a short queue instead of failing, and rate-limited
+  calls are retried until the queue timeout runs out
+
+Store access is blocking SQLite, so the async entry points run it in a
+worker thread to keep the event loop (and the pre-check branch) free.
+"""
+
+import asyncio
+import contextlib
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import uuid
+import weakref
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+
+DEFAULT_STORE_PATH = os.path.join(tempfile.gettempdir(), "oracle_upstream_governor.sqlite3")
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+STATE_COLUMNS = ("requests", "request_rate", "tokens", "token_rate", "concurrency", "blocked_until", "updated")
+USAGE_COLUMNS = ("requests", "successes", "failures", "tokens", "ejections")
+TOKEN_BURST_SECONDS = 10  # The token bucket holds this many seconds of the token rate
+
+
+class GovernorTimeout(Exception):
+    """Raised when a request waited longer than the queue timeout for a slot."""
+
+
+def parse_duration(value):
+    """Parse an OpenAI reset duration such as '20ms', '1s' or '6m0s' into seconds."""
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def retry_after(headers):
+    """Return how long the upstream asked us to wait, in seconds, if it said."""
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    return parse_duration(headers.get("retry-after"))
+
+
+class UpstreamGovernor:
+    """Request and token buckets with adaptive concurrency, shared across processes.
+
+    Args:
+        name: Key for this upstream in the shared store; governors with the
+            same name and store path share one budget.
+        store_path: SQLite file holding the shared state.
+        requests_per_minute: Starting request rate, replaced by the limit
+            reported in x-ratelimit-limit-requests.
+        tokens_per_minute: Starting token rate, replaced by the limit
+            reported in x-ratelimit-limit-tokens.
+        completion_tokens: Completion length assumed when estimating the
+            cost of a call before it is made.
+        max_concurrency: Upper bound for the adaptive concurrency limit.
+        min_concurrency: Lower bound the limit never drops below.
+        queue_timeout: Seconds a call may wait for a slot before failing.
+        lease_seconds: Slots older than this are treated as abandoned, so a
+            crashed worker cannot leak capacity.
+    """
+
+    def __init__(self, name="openai", store_path=DEFAULT_STORE_PATH, requests_per_minute=500,
+                 tokens_per_minute=10000, completion_tokens=256, max_concurrency=8, min_concurrency=1,
+                 queue_timeout=10.0, lease_seconds=120.0):
+        self.name = name
+        self.store_path = store_path
+        self.initial_request_rate = requests_per_minute / 60
+        self.initial_token_rate = tokens_per_minute / 60
+        self.completion_tokens = completion_tokens
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.queue_timeout = queue_timeout
+        self.lease_seconds = lease_seconds
+        self._init_store()
+
+    @classmethod
+    def from_env(cls, name="openai"):
+        """Build a governor from UPSTREAM_* environment variables."""
+        return cls(
+            name=name,
+            store_path=os.getenv("UPSTREAM_GOVERNOR_DB", DEFAULT_STORE_PATH),
+            requests_per_minute=float(os.getenv("UPSTREAM_RPM_LIMIT", 500)),
+            tokens_per_minute=float(os.getenv("UPSTREAM_TPM_LIMIT", 10000)),
+            completion_tokens=int(os.getenv("UPSTREAM_COMPLETION_TOKENS", 256)),
+            max_concurrency=int(os.getenv("UPSTREAM_MAX_CONCURRENCY", 8)),
+            queue_timeout=float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", 10)),
+        )
+
+    # --- Shared store ---
+
+    def _connect(self):
+        # Autocommit mode so BEGIN IMMEDIATE controls the write lock explicitly
+        return sqlite3.connect(self.store_path, timeout=5.0, isolation_level=None)
+
+    @staticmethod
+    def _token_capacity(state):
+        return max(state["token_rate"] * TOKEN_BURST_SECONDS, 1.0)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Lock the store, yield the current state row, and write it back."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(f"SELECT {', '.join(STATE_COLUMNS)} FROM limits WHERE name = ?",
+                               (self.name,)).fetchone()
+            now = time.time()
+            state = dict(zip(STATE_COLUMNS, row))
+            elapsed = now - state["updated"]
+            # Refill both buckets; the request bucket holds one second of requests
+            state["requests"] = min(max(state["request_rate"], 1.0),
+                                    state["requests"] + elapsed * state["request_rate"])
+            state["tokens"] = min(self._token_capacity(state),
+                                  state["tokens"] + elapsed * state["token_rate"])
+            state["updated"] = now
+            conn.execute("DELETE FROM slots WHERE name = ? AND acquired < ?",
+                         (self.name, now - self.lease_seconds))
+            yield conn, state, now
+            conn.execute(
+                f"UPDATE limits SET {', '.join(f'{column} = ?' for column in STATE_COLUMNS)} WHERE name = ?",
+                tuple(state[column] for column in STATE_COLUMNS) + (self.name,)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _init_store(self):
+        conn = self._connect()
+        try:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS limits (name TEXT PRIMARY KEY, "
+                         f"{', '.join(f'{column} REAL' for column in STATE_COLUMNS)})")
+            conn.execute("CREATE TABLE IF NOT EXISTS slots (id TEXT PRIMARY KEY, name TEXT, acquired REAL)")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS usage (name TEXT PRIMARY KEY, "
+                         f"{', '.join(f'{column} INTEGER DEFAULT 0' for column in USAGE_COLUMNS)}, "
+                         f"last_error TEXT)")
+            conn.execute("INSERT OR IGNORE INTO usage (name) VALUES (?)", (self.name,))
+            initial = {
+                "requests": max(self.initial_request_rate, 1.0),
+                "request_rate": self.initial_request_rate,
+                "tokens": max(self.initial_token_rate * TOKEN_BURST_SECONDS, 1.0),
+                "token_rate": self.initial_token_rate,
+                "concurrency": float(self.max_concurrency),
+                "blocked_until": 0.0,
+                "updated": time.time(),
+            }
+            conn.execute(
+                f"INSERT OR IGNORE INTO limits VALUES (?, {', '.join('?' for _ in STATE_COLUMNS)})",
+                (self.name,) + tuple(initial[column] for column in STATE_COLUMNS)
+            )
+        finally:
+            conn.close()
+
+    # --- Slots ---
+
+    def estimate_cost(self, messages):
+        """Estimate the tokens a call will use: about 4 characters per prompt token plus a completion."""
+        prompt = sum(len(str(getattr(msg, "content", msg))) for msg in messages) // 4 + 4 * len(messages)
+        return prompt + self.completion_tokens
+
+    def try_acquire(self, cost=0):
+        """Take a slot and charge cost tokens if capacity is free now.
+
+        A call larger than the whole token bucket is admitted once the
+        bucket is full and leaves it in debt, so it cannot wait forever.
+
+        Returns:
+            tuple: (slot id or None, seconds to wait before trying again).
+        """
+        with self._transaction() as (conn, state, now):
+            if now < state["blocked_until"]:
+                return None, state["blocked_until"] - now
+            in_flight = conn.execute("SELECT COUNT(*) FROM slots WHERE name = ?", (self.name,)).fetchone()[0]
+            if in_flight >= int(state["concurrency"]):
+                return None, 0.05
+            if state["requests"] < 1.0:
+                return None, (1.0 - state["requests"]) / state["request_rate"]
+            needed = min(cost, self._token_capacity(state))
+            if state["tokens"] < needed:
+                return None, (needed - state["tokens"]) / state["token_rate"]
+            state["requests"] -= 1.0
+            state["tokens"] -= cost
+            slot_id = uuid.uuid4().hex
+            conn.execute("INSERT INTO slots VALUES (?, ?, ?)", (slot_id, self.name, now))
+            return slot_id, 0.0
+
+    def release(self, slot_id):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM slots WHERE id = ?", (slot_id,))
+        finally:
+            conn.close()
+
+    def settle(self, estimated, actual):
+        """Correct the token bucket once a call's real token usage is known."""
+        with self._transaction() as (conn, state, now):
+            state["tokens"] = min(self._token_capacity(state), state["tokens"] + estimated - actual)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, deadline=None, cost=0):
+        """Wait in the queue for a slot and hold it for the duration of the block."""
+        deadline = deadline or time.monotonic() + self.queue_timeout
+        while True:
+            slot_id, wait = await self._acquire(cost)
+            if slot_id:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise GovernorTimeout(f"No upstream capacity for '{self.name}' before the deadline")
+            await asyncio.sleep(min(max(wait, 0.01), remaining))
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self.release, slot_id)
+
+    async def _acquire(self, cost):
+        """Run try_acquire in a worker thread so store locking never blocks the event loop.
+
+        If the caller is cancelled meanwhile (for example by the pre-check
+        branch), a slot taken by the still-running attempt is released.
+        """
+        attempt = asyncio.ensure_future(asyncio.to_thread(self.try_acquire, cost))
+        try:
+            return await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            attempt.add_done_callback(self._release_abandoned)
+            raise
+
+    def _release_abandoned(self, attempt):
+        if attempt.cancelled() or attempt.exception() is not None:
+            return
+        slot_id, _ = attempt.result()
+        if slot_id:
+            attempt.get_loop().run_in_executor(None, self.release, slot_id)
+
+    # --- Learning from responses ---
+
+    def observe(self, status_code, headers):
+        """Update the shared limits from an upstream response and count it as a request sent."""
+        with self._transaction() as (conn, state, now):
+            conn.execute("UPDATE usage SET requests = requests + 1 WHERE name = ?", (self.name,))
+            limit = _int_header(headers, "x-ratelimit-limit-requests")
+            if limit:
+                state["request_rate"] = limit / 60
+            remaining = _int_header(headers, "x-ratelimit-remaining-requests")
+            if remaining is not None:
+                state["requests"] = min(state["requests"], float(remaining))
+            token_limit = _int_header(headers, "x-ratelimit-limit-tokens")
+            if token_limit:
+                state["token_rate"] = token_limit / 60
+            remaining_tokens = _int_header(headers, "x-ratelimit-remaining-tokens")
+            if remaining_tokens is not None:
+                state["tokens"] = min(state["tokens"], float(remaining_tokens))
+
+            # An exhausted request or token budget pauses everyone until it resets
+            pause = 0.0
+            if remaining == 0:
+                pause = parse_duration(headers.get("x-ratelimit-reset-requests")) or 0.0
+            if remaining_tokens == 0:
+                pause = max(pause, parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0.0)
+
+            if status_code == 429:
+                # Multiplicative decrease
+                state["concurrency"] = max(float(self.min_concurrency), state["concurrency"] / 2)
+                state["requests"] = 0.0
+                pause = max(pause, retry_after(headers) or 1.0)
+            elif 200 <= status_code < 300:
+                # Additive increase: about one slot per window of successful calls
+                state["concurrency"] = min(float(self.max_concurrency),
+                                           state["concurrency"] + 1 / state["concurrency"])
+            if pause:
+                state["blocked_until"] = max(state["blocked_until"], now + pause)
+
+    async def httpx_response_hook(self, response):
+        """httpx event hook feeding every upstream response into the governor."""
+        await asyncio.to_thread(self.observe, response.status_code, response.headers)
+
+    # --- Usage reporting ---
+
+    def record_usage(self, last_error=None, **counts):
+        """Add to the shared usage counters, e.g. record_usage(requests=1, successes=1)."""
+        unknown = set(counts) - set(USAGE_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown usage counters: {sorted(unknown)}")
+        conn = self._connect()
+        try:
+            conn.execute(
+                f"UPDATE usage SET {', '.join(f'{column} = {column} + ?' for column in USAGE_COLUMNS)}, "
+                f"last_error = COALESCE(?, last_error) WHERE name = ?",
+                tuple(counts.get(column, 0) for column in USAGE_COLUMNS) + (last_error, self.name)
+            )
+        finally:
+            conn.close()
+
+    def usage(self):
+        """Return the usage counters shared by all workers, plus calls in flight."""
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT {', '.join(USAGE_COLUMNS)}, last_error FROM usage WHERE name = ?",
+                               (self.name,)).fetchone()
+            in_flight = conn.execute("SELECT COUNT(*) FROM slots WHERE name = ?", (self.name,)).fetchone()[0]
+        finally:
+            conn.close()
+        return dict(zip(USAGE_COLUMNS + ("last_error",), row), in_flight=in_flight)
+
+    def stats(self):
+        """Return a snapshot of the shared state for logging and tests."""
+        with self._transaction() as (conn, state, now):
+            in_flight = conn.execute("SELECT COUNT(*) FROM slots WHERE name = ?", (self.name,)).fetchone()[0]
+            return {
+                "requests_per_minute": round(state["request_rate"] * 60, 1),
+                "tokens_per_minute": round(state["token_rate"] * 60, 1),
+                "concurrency_limit": round(state["concurrency"], 2),
+                "in_flight": in_flight,
+                "request_budget": round(state["requests"], 2),
+                "token_budget": round(state["tokens"], 1),
+                "paused_for": round(max(0.0, state["blocked_until"] - now), 3),
+            }
+
+    # --- Calling the upstream ---
+
+    async def call(self, make_call, cost=0, deadline=None):
+        """Run make_call() under a slot, retrying rate-limited attempts until the deadline.
+
+        cost is the estimated token usage charged up front for each attempt;
+        it is refunded when the attempt fails and corrected with the usage
+        reported on the result, if any. deadline is a
+        time.monotonic() value and defaults to the queue timeout from now.
+        """
+        deadline = deadline or time.monotonic() + self.queue_timeout
+        while True:
+            async with self.slot(deadline, cost):
+                try:
+                    result = await make_call()
+                except Exception as e:
+                    if cost:
+                        # A failed attempt is not billed; give its estimate back so retries
+                        # are charged once, not once per attempt
+                        await asyncio.to_thread(self.settle, cost, 0)
+                    if getattr(e, "status_code", None) != 429 or time.monotonic() >= deadline:
+                        raise
+                    continue  # The response hook has already paused the buckets; queue again
+            usage = getattr(result, "usage_metadata", None) or {}
+            if cost and usage.get("total_tokens"):
+                await asyncio.to_thread(self.settle, cost, usage["total_tokens"])
+            return result
+
+
+class GovernedChatModel:
+    """Chat model wrapper that sends every call through an UpstreamGovernor.
+
+    httpx connection pools are tied to the event loop that opened them, so
+    one ChatOpenAI client is built per event loop the model is used from.
+    The OpenAI client's own retries are disabled so that 429s are queued
+    and retried by the governor, where all workers can see them.
+    """
+
+    def __init__(self, governor, **chat_kwargs):
+        self.governor = governor
+        self.chat_kwargs = chat_kwargs
+        self._llms = weakref.WeakKeyDictionary()
+
+    def _llm(self):
+        loop = asyncio.get_running_loop()
+        llm = self._llms.get(loop)
+        if llm is None:
+            http_client = httpx.AsyncClient(event_hooks={"response": [self.governor.httpx_response_hook]})
+            llm = ChatOpenAI(max_retries=0, http_async_client=http_client, **self.chat_kwargs)
+            self._llms[loop] = llm
+        return llm
+
+    async def ainvoke(self, messages, deadline=None, **kwargs):
+        cost = self.governor.estimate_cost(messages)
+        return await self.governor.call(lambda: self._llm().ainvoke(messages, **kwargs),
+                                        cost=cost, deadline=deadline)
+
+
+def create_governed_llm(governor, **chat_kwargs):
+    """Build a ChatOpenAI-backed model whose responses and calls go through the governor."""
+    return GovernedChatModel(governor, **chat_kwargs)
@@ -0,0 +1,268 @@
+"""
+Pool of upstream OpenAI credentials and endpoints.
+
+Spreads chat calls across several API keys and/or base URLs so throughput
+is not capped by a single organisation's quota:
+
+- weighted least-outstanding-requests balancing picks the upstream with
+  the fewest in-flight calls relative to its weight, and picks at random
+  by weight when in-flight counts are equal
+- upstreams that keep failing (connection errors, 5xx, rejected keys) are
+  ejected for a while and re-admitted afterwards; repeat ejections back
+  off exponentially
+- a call that fails on an unhealthy or saturated upstream fails over to
+  the next one
+- usage is counted per upstream in the governors' shared store, so the
+  totals cover every worker on the host
+
+Each upstream gets its own UpstreamGovernor, so per-key rate limits are
+learned and shared across workers separately.
+
+Upstreams are configured with OPENAI_UPSTREAMS, a JSON list such as:
+    [{"name": "primary", "api_key_env": "OPENAI_API_KEY", "weight": 2},
+     {"name": "secondary", "api_key_env": "OPENAI_API_KEY_2",
+      "base_url": "https://example.openai.azure.com/v1"}]
+Without it, the pool holds a single upstream using OPENAI_API_KEY.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import time
+
+from upstream_governor import GovernorTimeout, UpstreamGovernor, create_governed_llm
+
+logger = logging.getLogger(__name__)
+
+
+class NoHealthyUpstream(Exception):
+    """Raised when every upstream failed for a single call."""
+
+
+class Upstream:
+    """One credential/endpoint pair and this worker's view of its health.
+
+    Usage counters live in the governor's shared store, so they cover all
+    workers; in-flight counts and ejection state are local to this worker.
+    """
+
+    def __init__(self, name, llm, weight=1.0):
+        self.name = name
+        self.llm = llm
+        self.governor = llm.governor
+        self.weight = float(weight)
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    def is_ejected(self, now):
+        return now < self.ejected_until
+
+    def usage(self, now):
+        return dict(
+            self.governor.usage(),
+            weight=self.weight,
+            worker={"outstanding": self.outstanding, "ejected": self.is_ejected(now)},
+        )
+
+
+def classify_error(error):
+    """Decide how a failed upstream call should be treated.
+
+    Returns:
+        str: 'unhealthy' for connection errors, 5xx and rejected keys,
+            'saturated' for rate limits, or 'fatal' for errors that
+            another upstream would not fix (such as a bad request).
+    """
+    if isinstance(error, GovernorTimeout):
+        return "saturated"
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        return "saturated"
+    if status is None or status >= 500 or status in (401, 403):
+        return "unhealthy"
+    return "fatal"
+
+
+def _log_failed_usage_write(upstream, write):
+    if not write.cancelled() and write.exception() is not None:
+        logger.warning("Could not record usage for upstream %s: %s", upstream.name, write.exception())
+
+
+class UpstreamPool:
+    """Load-balanced pool of chat models with ejection and failover.
+
+    Args:
+        upstreams: The Upstream entries to balance across.
+        failure_threshold: Consecutive failures before an upstream is ejected.
+        ejection_seconds: How long the first ejection lasts.
+        max_ejection_seconds: Cap for the exponentially growing ejection time.
+        timeout: Overall seconds a call may spend queueing and failing over
+            across all upstreams; keep it below the gunicorn worker timeout.
+        failover_wait: Seconds to wait for a saturated upstream's capacity
+            while other healthy upstreams remain to be tried.
+    """
+
+    def __init__(self, upstreams, failure_threshold=3, ejection_seconds=30.0, max_ejection_seconds=300.0,
+                 timeout=30.0, failover_wait=1.0):
+        if not upstreams:
+            raise ValueError("UpstreamPool needs at least one upstream")
+        self.upstreams = list(upstreams)
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+        self.max_ejection_seconds = max_ejection_seconds
+        self.timeout = timeout
+        self.failover_wait = failover_wait
+
+    @classmethod
+    def from_configs(cls, configs, model="gpt-4", store_path=None, **pool_kwargs):
+        """Build a pool of governed ChatOpenAI upstreams from config dicts.
+
+        Each config may contain name, api_key or api_key_env, base_url, weight and model.
+        Governors use the UPSTREAM_* environment settings unless store_path is given.
+        """
+        upstreams = []
+        for index, config in enumerate(configs, start=1):
+            name = config.get("name", f"upstream-{index}")
+            api_key = config.get("api_key") or os.getenv(config.get("api_key_env", "OPENAI_API_KEY"))
+            if not api_key:
+                raise ValueError(f"No API key configured for upstream '{name}'")
+            if store_path is None:
+                governor = UpstreamGovernor.from_env(name=f"openai:{name}")
+            else:
+                governor = UpstreamGovernor(name=f"openai:{name}", store_path=store_path)
+            chat_kwargs = {"model": config.get("model", model), "api_key": api_key}
+            if config.get("base_url"):
+                chat_kwargs["base_url"] = config["base_url"]
+            upstreams.append(Upstream(name, create_governed_llm(governor, **chat_kwargs),
+                                      weight=config.get("weight", 1)))
+        return cls(upstreams, **pool_kwargs)
+
+    @classmethod
+    def from_env(cls, model="gpt-4"):
+        """Build the pool from OPENAI_UPSTREAMS, or a single OPENAI_API_KEY upstream."""
+        raw = os.getenv("OPENAI_UPSTREAMS")
+        if raw:
+            configs = json.loads(raw)
+        else:
+            configs = [{"name": "default", "api_key_env": "OPENAI_API_KEY",
+                        "base_url": os.getenv("OPENAI_BASE_URL")}]
+        return cls.from_configs(
+            configs,
+            model=model,
+            failure_threshold=int(os.getenv("UPSTREAM_FAILURE_THRESHOLD", 3)),
+            ejection_seconds=float(os.getenv("UPSTREAM_EJECTION_SECONDS", 30)),
+            timeout=float(os.getenv("UPSTREAM_POOL_TIMEOUT", 30)),
+            failover_wait=float(os.getenv("UPSTREAM_FAILOVER_WAIT", 1)),
+        )
+
+    def pick(self, exclude=()):
+        """Choose the upstream with the fewest outstanding calls per unit of weight.
+
+        When every healthy upstream has the same number of calls in flight,
+        as it always does in a worker that serves one request at a time, the
+        choice is random in proportion to weight so each upstream still gets
+        its share of traffic. Ejected upstreams are skipped. If every
+        candidate is ejected, the one closest to re-admission is used rather
+        than failing outright.
+        """
+        now = time.monotonic()
+        candidates = [u for u in self.upstreams if u not in exclude]
+        if not candidates:
+            return None
+        healthy = [u for u in candidates if not u.is_ejected(now)]
+        if not healthy:
+            return min(candidates, key=lambda u: u.ejected_until)
+        if len({u.outstanding for u in healthy}) == 1:
+            return random.choices(healthy, weights=[u.weight for u in healthy])[0]
+        best = min((u.outstanding + 1) / u.weight for u in healthy)
+        return random.choice([u for u in healthy if (u.outstanding + 1) / u.weight == best])
+
+    def _record_success(self, upstream):
+        upstream.consecutive_failures = 0
+        upstream.ejections = 0
+
+    def _record_failure(self, upstream):
+        """Count a health failure; return True if it ejected the upstream."""
+        upstream.consecutive_failures += 1
+        now = time.monotonic()
+        # Calls already in flight when the upstream was ejected do not extend it
+        if upstream.consecutive_failures >= self.failure_threshold and not upstream.is_ejected(now):
+            # Each ejection in a row lasts twice as long as the previous one
+            duration = min(self.max_ejection_seconds, self.ejection_seconds * 2 ** upstream.ejections)
+            upstream.ejected_until = now + duration
+            upstream.ejections += 1
+            return True
+        return False
+
+    async def ainvoke(self, messages, **kwargs):
+        """Send the call to the best upstream, failing over to others on upstream errors.
+
+        The whole call, failovers included, shares one deadline. Each attempt
+        is also bounded by the upstream governor's queue timeout, and while
+        other healthy upstreams remain untried, a saturated upstream only gets
+        failover_wait seconds to free capacity.
+        """
+        deadline = time.monotonic() + self.timeout
+        tried = []
+        last_error = None
+        while True:
+            upstream = self.pick(exclude=tried)
+            if upstream is None or time.monotonic() >= deadline:
+                raise NoHealthyUpstream(f"All {len(tried)} upstreams tried failed") from last_error
+            tried.append(upstream)
+            now = time.monotonic()
+            others = [u for u in self.upstreams if u not in tried and not u.is_ejected(now)]
+            # Each upstream gets at most its governor's queue timeout
+            attempt_deadline = min(deadline, now + upstream.governor.queue_timeout)
+            if others:
+                attempt_deadline = min(attempt_deadline, now + self.failover_wait)
+            upstream.outstanding += 1
+            try:
+                response = await upstream.llm.ainvoke(messages, deadline=attempt_deadline, **kwargs)
+            except Exception as e:
+                kind = classify_error(e)
+                counts = {}
+                error_name = None
+                if kind != "saturated":
+                    counts["failures"] = 1
+                    # Only the error type and status; messages can echo parts of the API key
+                    status = getattr(e, "status_code", None)
+                    error_name = type(e).__name__ + (f" ({status})" if status else "")
+                    if status is None:
+                        # No response came back; responses are counted as they arrive
+                        counts["requests"] = 1
+                if kind == "unhealthy" and self._record_failure(upstream):
+                    counts["ejections"] = 1
+                if counts:
+                    self._record_usage(upstream, last_error=error_name, **counts)
+                if kind == "fatal":
+                    raise
+                last_error = e
+                continue
+            else:
+                self._record_success(upstream)
+                tokens = (getattr(response, "usage_metadata", None) or {}).get("total_tokens", 0)
+                self._record_usage(upstream, successes=1, tokens=tokens)
+                return response
+            finally:
+                upstream.outstanding -= 1
+
+    def _record_usage(self, upstream, last_error=None, **counts):
+        """Add to the upstream's shared usage counters without delaying the call.
+
+        Usage is best effort: the write runs on the default executor, and a
+        busy or broken store is logged rather than failing the user's call.
+        """
+        write = asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(upstream.governor.record_usage, last_error=last_error, **counts))
+        write.add_done_callback(functools.partial(_log_failed_usage_write, upstream))
+
+    def usage(self):
+        """Return per-upstream usage across all workers, plus this worker's health view."""
+        now = time.monotonic()
+        return {u.name: u.usage(now) for u in self.upstreams}